@@ -21,6 +21,7 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 
 def verify_password(plain_password, hashed_password):
@@ -91,3 +92,34 @@ async def get_current_active_user(
     with Session(engine) as session:
         user = session.exec(st).first()
     return user
+
+
+async def get_current_stream_user(
+    token: Annotated[str | None, Depends(oauth2_scheme_optional)],
+    access_token: str | None = None,
+):
+    # The browser EventSource API cannot set headers, so streams also accept
+    # the token as the ``access_token`` query parameter.
+    user = await get_current_user(token or access_token or "")
+    return await get_current_active_user(user)
+
+
+async def get_current_admin_user(
+    current_user: Annotated[base_models.Users, Depends(get_current_active_user)]
+):
+    if current_user is None or not current_user.admin:
+        raise HTTPException(status_code=403, detail="Admin rights required")
+    return current_user
+
+
+def is_admin_token(token: str) -> bool:
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return False
+    st = select(base_models.Users).where(
+        base_models.Users.username == payload.get("sub")
+    )
+    with Session(engine) as session:
+        user = session.exec(st).first()
+    return user is not None and user.admin
@@ -0,0 +1,175 @@
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.hash import bcrypt
+from pydantic import ValidationError
+
+from src.model import base_models
+from src.model.conn import engine
+
+USER_FIELDS = ["username", "full_name", "email", "password"]
+
+_pool = None
+_pool_workers = 1
+_pool_lock = threading.Lock()
+
+
+def parse_users(data: str, fmt: str) -> list[dict]:
+    """Parse a CSV (with a header row) or a JSON list of users."""
+    if fmt == "json":
+        rows = json.loads(data)
+        if not isinstance(rows, list):
+            raise ValueError("JSON import must be a list of users")
+        return rows
+    if fmt == "csv":
+        return list(csv.DictReader(io.StringIO(data)))
+    raise ValueError(f"Unsupported import format: {fmt}")
+
+
+def _get_pool(workers: int | None = None) -> ProcessPoolExecutor:
+    # One pool per process, started through forkserver: forking the
+    # multi-threaded server directly can deadlock the children.
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None:
+            _pool_workers = workers or os.cpu_count() or 1
+            _pool = ProcessPoolExecutor(
+                max_workers=_pool_workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+    return _pool
+
+
+def hash_passwords(passwords: list[str], workers: int | None = None) -> list[str]:
+    """Hash passwords with bcrypt across a process pool."""
+    if len(passwords) < 2:
+        return [bcrypt.hash(password) for password in passwords]
+    pool = _get_pool(workers)
+    chunksize = max(1, len(passwords) // (_pool_workers * 4))
+    return list(pool.map(bcrypt.hash, passwords, chunksize=chunksize))
+
+
+def _validate(rows: list[dict], report: base_models.ImportReport) -> list[dict]:
+    users = []
+    seen_usernames = set()
+    seen_emails = set()
+    for i, row in enumerate(rows, start=1):
+        username = row.get("username") if isinstance(row, dict) else None
+        try:
+            user = base_models.UserCreate(**row)
+        except (TypeError, ValidationError) as e:
+            report.conflicts.append(
+                base_models.ImportConflict(row=i, username=username, detail=str(e))
+            )
+            continue
+
+        if not user.email:
+            report.conflicts.append(
+                base_models.ImportConflict(
+                    row=i, username=user.username, detail="Email is required"
+                )
+            )
+            continue
+
+        if user.username in seen_usernames or user.email in seen_emails:
+            report.conflicts.append(
+                base_models.ImportConflict(
+                    row=i, username=user.username, detail="Duplicate row in import"
+                )
+            )
+            continue
+
+        seen_usernames.add(user.username)
+        seen_emails.add(user.email)
+        users.append({"row": i, **user.model_dump()})
+    return users
+
+
+def import_users(rows: list[dict], workers: int | None = None):
+    """Create users from parsed rows in a single transaction.
+
+    Rows are loaded with COPY into a temporary table and inserted with
+    ON CONFLICT DO NOTHING, so rows clashing with existing users are reported
+    instead of aborting the whole import.
+    """
+    report = base_models.ImportReport()
+    users = _validate(rows, report)
+    if not users:
+        return report
+
+    hashed = hash_passwords([user["password"] for user in users], workers)
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for user, password in zip(users, hashed):
+        writer.writerow([user["username"], user["full_name"], user["email"], password])
+    buf.seek(0)
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE users_import "
+            "(username text, full_name text, email text, password text) "
+            "ON COMMIT DROP"
+        )
+        cursor.copy_expert(
+            "COPY users_import (username, full_name, email, password) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buf,
+        )
+        cursor.execute(
+            "WITH new_users AS ("
+            " INSERT INTO users (username, full_name, email, admin)"
+            " SELECT username, full_name, email, false FROM users_import"
+            " ON CONFLICT DO NOTHING RETURNING username"
+            ") "
+            "INSERT INTO passwords (username, password)"
+            " SELECT i.username, i.password FROM users_import i"
+            " JOIN new_users USING (username) "
+            "RETURNING username"
+        )
+        created = {username for (username,) in cursor.fetchall()}
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for user in users:
+        if user["username"] in created:
+            report.created.append(user["username"])
+        else:
+            report.conflicts.append(
+                base_models.ImportConflict(
+                    row=user["row"],
+                    username=user["username"],
+                    detail="User already exist",
+                )
+            )
+    report.conflicts.sort(key=lambda conflict: conflict.row)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import users")
+    parser.add_argument("path", type=str, help="CSV or JSON file with users")
+    parser.add_argument(
+        "--format", type=str, choices=["csv", "json"], help="file format"
+    )
+    parser.add_argument("--workers", type=int, help="password hashing processes")
+    args = parser.parse_args()
+
+    fmt = args.format or ("json" if args.path.endswith(".json") else "csv")
+    with open(args.path, encoding="utf-8") as f:
+        rows = parse_users(f.read(), fmt)
+
+    report = import_users(rows, args.workers)
+    print(report.model_dump_json(indent=2))
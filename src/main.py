@@ -1,28 +1,61 @@
 import argparse
+import asyncio
 import json
 import logging
 import os
+from contextlib import asynccontextmanager
 from datetime import timedelta
 from typing import Annotated
 
 import requests
 import uvicorn
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, HTTPException, Request, UploadFile, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from passlib.hash import bcrypt
 from pydantic import UUID4
+from sqlalchemy import insert, literal
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlmodel import Session, delete, select, update
 
-from src.auth import auth
-from src.model import base_models
-from src.model.conn import engine
+from src.auth import auth, bulk_import
+from src.middleware import admission, profiling
+from src.middleware.profiling import run_in_threadpool
+from src.model import archive, base_models, dedup, stats
+from src.model.conn import engine, mark_write, run_read
+from src.notify.broadcast import broadcaster, event_stream, user_channel
+
+
+async def archive_periodically(interval: int):
+    while True:
+        try:
+            await asyncio.to_thread(archive.archive_resolved_requests)
+        except Exception:
+            logging.exception("Archiving resolved user requests failed")
+        await asyncio.sleep(interval)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = []
+    if archive.ARCHIVE_INTERVAL_SECONDS > 0:
+        tasks.append(
+            asyncio.create_task(archive_periodically(archive.ARCHIVE_INTERVAL_SECONDS))
+        )
+    yield
+    for task in tasks:
+        task.cancel()
+
 
 app = FastAPI(
     title="Сваггер для сайта г.Зарафшан",
     description="Здесь лежит код бэкенда https://github.com/nevermarine/city-backend для этого сайта.",
     debug=True,
+    lifespan=lifespan,
 )
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(profiling.ProfilingMiddleware)
 
 TOPICS = [
     "Бизнес и экономика",
@@ -37,21 +70,50 @@ SOCIETY_TOPICS = ["Культура и развлечения", "Люди и о
 GOV_TOPICS = ["Бизнес и экономика", "Политика", "Наука и технологии"]
 
 
-def check_exist_user(username: str):
-    with Session(engine) as session:
-        statement = select(base_models.Users).where(
-            base_models.Users.username == username
-        )
-        find_user = session.exec(statement).first()
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Monitoring"])
+async def get_metrics():
+    return admission.render_metrics(admission.ROUTE_CLASSES)
 
-    return find_user
+
+@app.get("/admin/profiles", tags=["Monitoring"])
+async def get_profiles(
+    current_user: Annotated[base_models.Users, Depends(auth.get_current_admin_user)]
+):
+    return [
+        {key: value for key, value in profile.items() if key != "folded"}
+        for profile in profiling.profiles
+    ]
+
+
+@app.get(
+    "/admin/profiles/{profile_id}",
+    response_class=PlainTextResponse,
+    tags=["Monitoring"],
+)
+async def get_profile(
+    profile_id: str,
+    current_user: Annotated[base_models.Users, Depends(auth.get_current_admin_user)],
+):
+    for profile in profiling.profiles:
+        if profile["id"] == profile_id:
+            return profile["folded"]
+    raise HTTPException(status_code=404, detail="Profile not found")
+
+
+@app.get("/admin/slow_queries", tags=["Monitoring"])
+async def get_slow_queries(
+    current_user: Annotated[base_models.Users, Depends(auth.get_current_admin_user)]
+):
+    return list(profiling.slow_queries)
 
 
 @app.post("/token", response_model=base_models.Token, tags=["Users"])
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
 ):
-    user = auth.authenticate_user(form_data.username, form_data.password)
+    user = await run_in_threadpool(
+        auth.authenticate_user, form_data.username, form_data.password
+    )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -74,96 +136,166 @@ async def read_users_me(
 
 @app.post("/users/create", response_model=base_models.Users, tags=["Users"])
 async def create_user(user: base_models.UserCreate):
-    with Session(engine) as session:
-        statement = select(base_models.Users).where(
-            base_models.Users.username == user.username
+    user_data = user.model_dump()
+    hashed_password = await run_in_threadpool(bcrypt.hash, user_data["password"])
+
+    new_user_json = {
+        "username": user_data["username"],
+        "full_name": user_data["full_name"],
+        "email": user_data["email"],
+    }
+
+    # Both rows are written by one statement, so a concurrent signup with the
+    # same username or email loses on the unique constraint instead of racing.
+    new_user = (
+        pg_insert(base_models.Users)
+        .values(admin=False, **new_user_json)
+        .on_conflict_do_nothing()
+        .returning(base_models.Users.username)
+        .cte("new_user")
+    )
+    statement = (
+        insert(base_models.Passwords)
+        .from_select(
+            ["username", "password"],
+            select(new_user.c.username, literal(hashed_password)),
         )
-        find_user = session.exec(statement).first()
-
-        if find_user is None:
-            user_data = user.model_dump()
-            hashed_password = bcrypt.hash(user_data["password"])
-
-            new_user_json = {
-                "username": user_data["username"],
-                "full_name": user_data["full_name"],
-                "email": user_data["email"],
-            }
-            new_pass_user_json = {
-                "username": user_data["username"],
-                "password": hashed_password,
-            }
-
-            new_user = base_models.Users(**new_user_json)
-            session.add(new_user)
-            session.commit()
+        .returning(base_models.Passwords.username)
+    )
 
-            new_pass_user = base_models.Passwords(**new_pass_user_json)
-            session.add(new_pass_user)
-            session.commit()
+    with Session(engine) as session:
+        created = session.execute(statement).first()
+        session.commit()
+
+    if created is None:
+        raise HTTPException(status_code=404, detail="User already exist")
 
-            return base_models.Users(**new_user_json)
+    mark_write(user.username)
+    return base_models.Users(**new_user_json)
+
+
+@app.post("/users/import", response_model=base_models.ImportReport, tags=["Users"])
+async def import_users(
+    file: UploadFile,
+    current_user: Annotated[base_models.Users, Depends(auth.get_current_admin_user)],
+):
+    fmt = "json" if (file.filename or "").endswith(".json") else "csv"
+    try:
+        rows = bulk_import.parse_users((await file.read()).decode("utf-8"), fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        else:
-            raise HTTPException(status_code=404, detail="User already exist")
+    report = await run_in_threadpool(bulk_import.import_users, rows)
+    for username in report.created:
+        mark_write(username)
+    return report
 
 
 @app.delete("/users/{username}", response_model=base_models.Users, tags=["Users"])
 async def delete_user(username: str):
-    with Session(engine) as session:
-        statement = select(base_models.Users).where(
-            base_models.Users.username == username
-        )
-        find_user = session.exec(statement).first()
+    deleted_passwords = (
+        delete(base_models.Passwords)
+        .where(base_models.Passwords.username == username)
+        .cte("deleted_passwords")
+    )
+    deleted_requests = (
+        delete(base_models.UserRequest)
+        .where(base_models.UserRequest.username == username)
+        .cte("deleted_requests")
+    )
+    deleted_archive = (
+        delete(base_models.UserRequestArchive)
+        .where(base_models.UserRequestArchive.username == username)
+        .cte("deleted_archive")
+    )
+    statement = (
+        delete(base_models.Users)
+        .where(base_models.Users.username == username)
+        .returning(base_models.Users)
+        .add_cte(deleted_passwords, deleted_requests, deleted_archive)
+    )
 
-        if find_user is not None:
-            session.delete(find_user)
-            session.commit()
-            return find_user
-        else:
-            raise HTTPException(status_code=404, detail="User not found")
+    with Session(engine, expire_on_commit=False) as session:
+        find_user = session.scalars(statement).first()
+        session.commit()
+
+    if find_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    mark_write(username)
+    return find_user
 
 
 @app.get("/users", response_model=list[base_models.Users], tags=["Users"])
 async def get_all_users():
-    with Session(engine) as session:
-        statement = select(base_models.Users)
-        users = session.exec(statement).all()
+    statement = select(base_models.Users)
+    users = run_read(lambda session: session.exec(statement).all())
     return users
 
 
 @app.put("/users/{username}", response_model=base_models.Users, tags=["Users"])
 async def update_user(username: str, new_user_data: base_models.Users):
-    find_user = check_exist_user(username)
-    if find_user is not None:
-        with Session(engine) as session:
-            logging.info(find_user)
-            find_user.email = new_user_data.email
-            find_user.full_name = new_user_data.full_name
-            session.add(find_user)
-            session.commit()
-            session.refresh(find_user)
-            return find_user
-    else:
+    statement = (
+        update(base_models.Users)
+        .where(base_models.Users.username == username)
+        .values(email=new_user_data.email, full_name=new_user_data.full_name)
+        .returning(base_models.Users)
+    )
+
+    with Session(engine, expire_on_commit=False) as session:
+        find_user = session.scalars(statement).first()
+        session.commit()
+
+    if find_user is None:
         raise HTTPException(status_code=404, detail="User not found")
 
+    logging.info(find_user)
+    mark_write(username)
+    return find_user
+
 
 @app.get("/users/me/items/", tags=["Users"])
 async def read_own_items(
-    current_user: Annotated[base_models.Users, Depends(auth.get_current_active_user)]
+    current_user: Annotated[base_models.Users, Depends(auth.get_current_active_user)],
+    archived: bool = False,
 ):
     if current_user.admin:
-        with Session(engine) as session:
+
+        def query(session):
             statement = select(base_models.UserRequest)
             users = session.exec(statement).all()
-        return users
+            if archived:
+                statement = select(base_models.UserRequestArchive)
+                users += session.exec(statement).all()
+            return users
+
+        return run_read(query, current_user.username)
     else:
-        with Session(engine) as session:
+
+        def query(session):
             statement = select(base_models.UserRequest).where(
                 base_models.UserRequest.username == current_user.username
             )
             requests = session.exec(statement).all()
-        return requests
+            if archived:
+                statement = select(base_models.UserRequestArchive).where(
+                    base_models.UserRequestArchive.username == current_user.username
+                )
+                requests += session.exec(statement).all()
+            return requests
+
+        return run_read(query, current_user.username)
+
+
+@app.get("/users/me/stream", tags=["Users"])
+async def stream_own_items(
+    request: Request,
+    current_user: Annotated[base_models.Users, Depends(auth.get_current_stream_user)],
+):
+    channels = [user_channel(current_user.username)]
+    return StreamingResponse(
+        event_stream(request, channels), media_type="text/event-stream"
+    )
 
 
 @app.get(
@@ -173,12 +305,23 @@ async def read_own_items(
 )
 async def read_own_user_reqs_by_id(
     id_request: str,
+    archived: bool = False,
 ):
+    # Read from the primary: clients fetch a request right after creating it,
+    # before a replica may have it.
     with Session(engine) as session:
         statement = select(base_models.UserRequest).where(
             base_models.UserRequest.id == id_request
         )
         request_info = session.exec(statement).first()
+        if request_info is None and archived:
+            statement = select(base_models.UserRequestArchive).where(
+                base_models.UserRequestArchive.id == id_request
+            )
+            request_info = session.exec(statement).first()
+
+    if request_info is None:
+        raise HTTPException(status_code=404, detail="User request not found")
 
     return request_info
 
@@ -198,6 +341,7 @@ async def create_user_request(
         session.add(request)
         session.commit()
         session.refresh(request)
+    mark_write(current_user.username)
 
     return request
 
@@ -206,31 +350,41 @@ async def create_user_request(
 async def update_user_request_status(
     id_request: str, status: base_models.UserReqStatus
 ):
-    with Session(engine) as session:
+    with Session(engine, expire_on_commit=False) as session:
         statement = (
             update(base_models.UserRequest)
             .where(base_models.UserRequest.id == id_request)
             .values(status=status)
+            .returning(base_models.UserRequest)
         )
 
-        session.exec(statement)
+        request = session.scalars(statement).first()
         session.commit()
 
+    if request is not None:
+        mark_write(request.username)
+        broadcaster.publish(user_channel(request.username), "status", request)
+
     return {"message": "Status updated successfully"}
 
 
 @app.put("/user_reqs/{id_request}/response/", tags=["User's requests"])
 async def add_user_request_response(id_request: str, response: str):
-    with Session(engine) as session:
+    with Session(engine, expire_on_commit=False) as session:
         statement = (
             update(base_models.UserRequest)
             .where(base_models.UserRequest.id == id_request)
             .values(response=response)
+            .returning(base_models.UserRequest)
         )
 
-        session.exec(statement)
+        request = session.scalars(statement).first()
         session.commit()
 
+    if request is not None:
+        mark_write(request.username)
+        broadcaster.publish(user_channel(request.username), "response", request)
+
     return {"message": "Response added successfully"}
 
 
@@ -252,49 +406,89 @@ async def delete_user_request(id_request: str):
     response_model=list[base_models.UserRequest],
     tags=["User's requests"],
 )
-async def get_user_requests(username: str):
-    with Session(engine) as session:
+async def get_user_requests(username: str, archived: bool = False):
+    def query(session):
         statement = select(base_models.UserRequest).where(
             base_models.UserRequest.username == username
         )
         user_requests = session.exec(statement).all()
+        if archived:
+            statement = select(base_models.UserRequestArchive).where(
+                base_models.UserRequestArchive.username == username
+            )
+            user_requests += session.exec(statement).all()
+        return user_requests
 
-    return user_requests
+    return run_read(query, username)
 
 
 @app.post("/news/create", response_model=base_models.News, tags=["News"])
 async def create_news(news: base_models.News):
-    HOST_NEWS_TAG = os.getenv("HOST_NEWS_TAG")
-    HOST_SUMMARY = os.getenv("HOST_SUMMARY")
-    response = requests.post(HOST_NEWS_TAG, json={"text_news": [news.text]})
-    news.tag = response.json()["tags"][0]
-
-    if news.tag in SOCIETY_TOPICS:
-        news.category = "society"
-    elif news.tag in GOV_TOPICS:
-        news.category = "authority"
-
-    response = requests.post(
-        HOST_SUMMARY,
-        json={"model": "summarization", "stream": False, "prompt": news.text},
-    )
-    news.title = response.json()["response"]
+    # Wire feeds repeat stories with small edits; catch them before paying
+    # for the tagging and summary calls. The signature is reserved right
+    # away so a copy arriving during those calls is caught too.
+    signature = await run_in_threadpool(dedup.signature, news.text)
+    if signature:
+        duplicate_of = await run_in_threadpool(dedup.reserve, news.id, signature)
+        if duplicate_of is not None:
+            raise HTTPException(
+                status_code=409,
+                detail={
+                    "message": "News already exist",
+                    "duplicate_of": str(duplicate_of),
+                },
+            )
 
-    with Session(engine) as session:
-        session.add(news)
-        session.commit()
-        session.refresh(news)
+    try:
+        HOST_NEWS_TAG = os.getenv("HOST_NEWS_TAG")
+        HOST_SUMMARY = os.getenv("HOST_SUMMARY")
+        response = await run_in_threadpool(
+            requests.post, HOST_NEWS_TAG, json={"text_news": [news.text]}
+        )
+        news.tag = response.json()["tags"][0]
+
+        if news.tag in SOCIETY_TOPICS:
+            news.category = "society"
+        elif news.tag in GOV_TOPICS:
+            news.category = "authority"
+
+        response = await run_in_threadpool(
+            requests.post,
+            HOST_SUMMARY,
+            json={"model": "summarization", "stream": False, "prompt": news.text},
+        )
+        news.title = response.json()["response"]
+
+        with Session(engine) as session:
+            session.add(news)
+            stats.bump(session, stats.news_keys(news), 1)
+            session.commit()
+            session.refresh(news)
+    except Exception:
+        if signature:
+            await run_in_threadpool(dedup.release, news.id)
+        raise
+    broadcaster.publish("news", "created", news)
 
     return news
 
 
+@app.get("/stats", tags=["Stats"])
+async def get_stats():
+    return run_read(stats.read_stats)
+
+
+@app.get("/news/stream", tags=["News"])
+async def stream_news(request: Request):
+    return StreamingResponse(
+        event_stream(request, ["news"]), media_type="text/event-stream"
+    )
+
+
 @app.get("/news/category/{category}", tags=["News"])
 async def get_news_by_category(category: str):
-    with Session(engine) as session:
-        statement = select(base_models.News).where(
-            base_models.News.category == category
-        )
-        news_list = session.exec(statement).all()
+    statement = select(base_models.News).where(base_models.News.category == category)
+    news_list = run_read(lambda session: session.exec(statement).all())
 
     return news_list
 
@@ -302,28 +496,37 @@ async def get_news_by_category(category: str):
 @app.delete("/news/{news_id}", tags=["News"])
 async def delete_news(news_id: str):
     with Session(engine) as session:
-        statement = delete(base_models.News).where(base_models.News.id == news_id)
-        session.exec(statement)
+        statement = (
+            delete(base_models.News)
+            .where(base_models.News.id == news_id)
+            .returning(base_models.News)
+        )
+        for news in session.scalars(statement).all():
+            stats.bump(session, stats.news_keys(news), -1)
+        session.exec(
+            delete(base_models.NewsSignature).where(
+                base_models.NewsSignature.news_id == news_id
+            )
+        )
+        session.commit()
 
     return {"message": "News deleted successfully"}
 
 
 @app.get("/news/{id}", tags=["News"])
 async def get_news_by_id(id: UUID4):
-    with Session(engine) as session:
-        statement = select(base_models.News).where(base_models.News.id == id)
-        news = session.exec(statement).first()
-        if news is None:
-            raise HTTPException(status_code=404, detail="News not found")
+    statement = select(base_models.News).where(base_models.News.id == id)
+    news = run_read(lambda session: session.exec(statement).first())
+    if news is None:
+        raise HTTPException(status_code=404, detail="News not found")
 
     return news
 
 
 @app.get("/news", tags=["News"])
 async def get_news():
-    with Session(engine) as session:
-        statement = select(base_models.News)
-        news = session.exec(statement).all()
+    statement = select(base_models.News)
+    news = run_read(lambda session: session.exec(statement).all())
 
     return news
 
@@ -332,19 +535,27 @@ async def get_news():
 async def create_event(event: base_models.Events):
     with Session(engine) as session:
         session.add(event)
+        stats.bump(session, stats.event_keys(event), 1)
         session.commit()
         session.refresh(event)
+    broadcaster.publish("events", "created", event)
 
     return event
 
 
+@app.get("/events/stream", tags=["Events"])
+async def stream_events(request: Request):
+    return StreamingResponse(
+        event_stream(request, ["events"]), media_type="text/event-stream"
+    )
+
+
 @app.get("/events/location/{location}", tags=["Events"])
 async def get_events_by_location(location: str):
-    with Session(engine) as session:
-        statement = select(base_models.Events).where(
-            base_models.Events.location == location
-        )
-        events_list = session.exec(statement).all()
+    statement = select(base_models.Events).where(
+        base_models.Events.location == location
+    )
+    events_list = run_read(lambda session: session.exec(statement).all())
 
     return events_list
 
@@ -352,8 +563,13 @@ async def get_events_by_location(location: str):
 @app.delete("/events/{id}", tags=["Events"])
 async def delete_event(id: str):
     with Session(engine) as session:
-        statement = delete(base_models.Events).where(base_models.Events.id == id)
-        session.exec(statement)
+        statement = (
+            delete(base_models.Events)
+            .where(base_models.Events.id == id)
+            .returning(base_models.Events)
+        )
+        for event in session.scalars(statement).all():
+            stats.bump(session, stats.event_keys(event), -1)
         session.commit()
 
     return {"message": "Event deleted successfully"}
@@ -361,20 +577,18 @@ async def delete_event(id: str):
 
 @app.get("/events/{id}", tags=["Events"])
 async def get_event_by_id(id: UUID4):
-    with Session(engine) as session:
-        statement = select(base_models.Events).where(base_models.Events.id == id)
-        event = session.exec(statement).first()
-        if event is None:
-            raise HTTPException(status_code=404, detail="Event not found")
+    statement = select(base_models.Events).where(base_models.Events.id == id)
+    event = run_read(lambda session: session.exec(statement).first())
+    if event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
 
     return event
 
 
 @app.get("/events", tags=["Events"])
 async def get_events():
-    with Session(engine) as session:
-        statement = select(base_models.Events)
-        events = session.exec(statement).all()
+    statement = select(base_models.Events)
+    events = run_read(lambda session: session.exec(statement).all())
 
     return events
 
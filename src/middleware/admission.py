@@ -0,0 +1,143 @@
+import asyncio
+import json
+import time
+
+from src.model.base_models import config
+from src.notify.broadcast import STREAM_PATHS
+
+
+class RouteClass:
+    """Concurrency limit with a bounded wait queue for a group of routes."""
+
+    def __init__(self, name: str, limit: int, queue: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_time = 0.0
+        self._semaphore = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it binds to the running event loop.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    async def acquire(self) -> bool:
+        start = time.perf_counter()
+        if self.semaphore.locked():
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self.semaphore.acquire()
+
+        self.queue_time += time.perf_counter() - start
+        self.admitted += 1
+        self.in_flight += 1
+        return True
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.semaphore.release()
+
+
+def _route_class(name: str, limit: int, queue: int, timeout: float) -> RouteClass:
+    prefix = f"ADMISSION_{name.upper()}_"
+    return RouteClass(
+        name,
+        limit=int(config.get(prefix + "LIMIT") or limit),
+        queue=int(config.get(prefix + "QUEUE") or queue),
+        timeout=float(config.get(prefix + "TIMEOUT") or timeout),
+    )
+
+
+ROUTE_CLASSES = {
+    "ml": _route_class("ml", limit=2, queue=8, timeout=30),
+    "hashing": _route_class("hashing", limit=4, queue=32, timeout=10),
+    "default": _route_class("default", limit=64, queue=256, timeout=5),
+}
+
+# (method, path) pairs of expensive routes; everything else is "default".
+ROUTES = {
+    ("POST", "/news/create"): "ml",
+    ("POST", "/token"): "hashing",
+    ("POST", "/users/create"): "hashing",
+    ("POST", "/users/import"): "hashing",
+}
+
+# Long-lived streams would hold a slot forever, so they are never limited.
+EXEMPT_PATHS = STREAM_PATHS | {"/metrics"}
+
+RETRY_AFTER_SECONDS = int(config.get("ADMISSION_RETRY_AFTER") or 1)
+
+
+def render_metrics(classes: dict[str, RouteClass]) -> str:
+    """Render admission counters in the Prometheus text format."""
+    lines = []
+    metrics = [
+        ("admission_in_flight", "gauge", "in_flight"),
+        ("admission_waiting", "gauge", "waiting"),
+        ("admission_admitted_total", "counter", "admitted"),
+        ("admission_rejected_total", "counter", "rejected"),
+        ("admission_queue_seconds_total", "counter", "queue_time"),
+    ]
+    for metric, kind, attr in metrics:
+        lines.append(f"# TYPE {metric} {kind}")
+        for route_class in classes.values():
+            value = getattr(route_class, attr)
+            lines.append(f'{metric}{{route_class="{route_class.name}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+class AdmissionMiddleware:
+    """Caps in-flight requests per route class and sheds the excess with 503."""
+
+    def __init__(self, app, classes=None, routes=None):
+        self.app = app
+        self.classes = ROUTE_CLASSES if classes is None else classes
+        self.routes = ROUTES if routes is None else routes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        name = self.routes.get((scope["method"], scope["path"]), "default")
+        route_class = self.classes[name]
+        if not await route_class.acquire():
+            await self._reject(send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route_class.release()
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": "Server is overloaded, retry later"}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 503,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(RETRY_AFTER_SECONDS).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
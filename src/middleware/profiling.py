@@ -0,0 +1,199 @@
+import collections
+import contextvars
+import datetime
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+
+from fastapi import concurrency
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src.auth import auth
+from src.model.base_models import config
+from src.notify.broadcast import STREAM_PATHS
+
+PROFILE_SAMPLE_RATE = float(config.get("PROFILE_SAMPLE_RATE") or 0)
+PROFILE_INTERVAL_SECONDS = float(config.get("PROFILE_INTERVAL_SECONDS") or 0.005)
+PROFILE_HEADER = b"x-profile"
+SLOW_QUERY_MS = float(config.get("SLOW_QUERY_MS") or 200)
+
+profiles = collections.deque(maxlen=int(config.get("PROFILE_KEEP") or 50))
+slow_queries = collections.deque(maxlen=int(config.get("SLOW_QUERY_KEEP") or 200))
+
+current_route = contextvars.ContextVar("current_route", default=None)
+current_sampler = contextvars.ContextVar("current_sampler", default=None)
+
+
+class Sampler:
+    """Statistical profiler sampling the stacks of a request's threads.
+
+    Samples are aggregated in the folded format understood by flamegraph.pl
+    and speedscope. Besides the event loop thread, worker threads join while
+    they run the request's ``run_in_threadpool`` calls. Coroutines of
+    concurrent requests running on the same event loop thread show up in the
+    samples too.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL_SECONDS):
+        self.thread_ids = {thread_id}
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def add_thread(self, thread_id: int) -> None:
+        with self._lock:
+            self.thread_ids.add(thread_id)
+
+    def remove_thread(self, thread_id: int) -> None:
+        with self._lock:
+            self.thread_ids.discard(thread_id)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                thread_ids = list(self.thread_ids)
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+                    )
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    """``fastapi.concurrency.run_in_threadpool`` that profiles the worker too."""
+    sampler = current_sampler.get()
+    if sampler is None:
+        return await concurrency.run_in_threadpool(func, *args, **kwargs)
+
+    def run():
+        thread_id = threading.get_ident()
+        sampler.add_thread(thread_id)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            sampler.remove_thread(thread_id)
+
+    return await concurrency.run_in_threadpool(run)
+
+
+async def _wants_profile(path: str, headers: dict[bytes, bytes]) -> bool:
+    # Streams stay open indefinitely and would keep a sampler running.
+    if path in STREAM_PATHS:
+        return False
+    if PROFILE_HEADER in headers:
+        authorization = headers.get(b"authorization", b"").decode()
+        scheme, _, token = authorization.partition(" ")
+        return scheme.lower() == "bearer" and await concurrency.run_in_threadpool(
+            auth.is_admin_token, token
+        )
+    return random.random() < PROFILE_SAMPLE_RATE
+
+
+class ProfilingMiddleware:
+    """Profiles sampled requests and tags SQL issued by a request with its route."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = f"{scope['method']} {scope['path']}"
+        token = current_route.set(route)
+        try:
+            if not await _wants_profile(scope["path"], dict(scope["headers"])):
+                await self.app(scope, receive, send)
+                return
+
+            profile_id = str(uuid.uuid4())
+            sampler = Sampler(threading.get_ident())
+
+            async def send_with_id(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-profile-id", profile_id.encode())
+                    ]
+                await send(message)
+
+            start = time.perf_counter()
+            sampler.start()
+            sampler_token = current_sampler.set(sampler)
+            try:
+                await self.app(scope, receive, send_with_id)
+            finally:
+                current_sampler.reset(sampler_token)
+                folded = sampler.stop()
+                profiles.append(
+                    {
+                        "id": profile_id,
+                        "route": route,
+                        "created": datetime.datetime.now(),
+                        "duration_ms": (time.perf_counter() - start) * 1000,
+                        "folded": folded,
+                    }
+                )
+        finally:
+            current_route.reset(token)
+
+
+def _parameters_shape(parameters, executemany: bool):
+    if executemany:
+        return {"rows": len(parameters)}
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - conn.info["query_start"].pop()) * 1000
+    if duration_ms < SLOW_QUERY_MS:
+        return
+
+    query = {
+        "sql": statement,
+        "parameters": _parameters_shape(parameters, executemany),
+        "duration_ms": duration_ms,
+        "route": current_route.get(),
+        "created": datetime.datetime.now(),
+    }
+    slow_queries.append(query)
+    logging.warning(
+        "Slow query (%.1f ms) in %s: %s", duration_ms, query["route"], statement
+    )
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    if context.connection is not None and context.connection.info.get("query_start"):
+        context.connection.info["query_start"].pop()
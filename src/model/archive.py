@@ -0,0 +1,92 @@
+import argparse
+import datetime
+import logging
+
+from sqlalchemy import func, insert, text
+from sqlmodel import Session, delete, select
+
+from src.model import base_models
+from src.model.base_models import config
+from src.model.conn import engine
+
+ARCHIVE_AFTER_DAYS = int(config.get("ARCHIVE_AFTER_DAYS") or 30)
+ARCHIVE_INTERVAL_SECONDS = int(config.get("ARCHIVE_INTERVAL_SECONDS") or 0)
+
+ARCHIVE_COLUMNS = ["id", "username", "message", "status", "response", "date"]
+
+
+def _month_bounds(month: datetime.datetime):
+    start = month.date().replace(day=1)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return start, end
+
+
+def _ensure_partitions(session: Session, months) -> None:
+    table = base_models.UserRequestArchive.__tablename__
+    for month in months:
+        start, end = _month_bounds(month)
+        session.exec(
+            text(
+                f"CREATE TABLE IF NOT EXISTS {table}_{start:%Y_%m} "
+                f"PARTITION OF {table} FOR VALUES FROM ('{start}') TO ('{end}')"
+            )
+        )
+
+
+def archive_resolved_requests(older_than_days: int | None = None) -> int:
+    """Move resolved requests older than ``older_than_days`` to the archive.
+
+    Returns the number of archived requests.
+    """
+    if older_than_days is None:
+        older_than_days = ARCHIVE_AFTER_DAYS
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than_days)
+    request = base_models.UserRequest
+    condition = (request.status == base_models.UserReqStatus.resolved) & (
+        request.date < cutoff
+    )
+
+    moved = (
+        delete(request)
+        .where(condition)
+        .returning(*[getattr(request, column) for column in ARCHIVE_COLUMNS])
+        .cte("moved")
+    )
+    statement = (
+        insert(base_models.UserRequestArchive)
+        .from_select(
+            ARCHIVE_COLUMNS + ["archived_at"],
+            select(*[moved.c[column] for column in ARCHIVE_COLUMNS], func.now()),
+        )
+        .returning(base_models.UserRequestArchive.id)
+    )
+
+    with Session(engine) as session:
+        # The month lookup and the move must see the same rows; otherwise a
+        # request resolved in between could land in a month with no partition.
+        # A concurrent update makes the transaction fail and the next run retry.
+        session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        months = session.exec(
+            select(func.date_trunc("month", request.date)).where(condition).distinct()
+        ).all()
+        if not months:
+            return 0
+        _ensure_partitions(session, months)
+        archived = len(session.execute(statement).all())
+        session.commit()
+
+    logging.info("Archived %d resolved user requests", archived)
+    return archived
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive resolved user requests")
+    parser.add_argument(
+        "--older-than-days",
+        type=int,
+        default=ARCHIVE_AFTER_DAYS,
+        help="archive resolved requests older than this many days",
+    )
+    args = parser.parse_args()
+
+    print(archive_resolved_requests(args.older_than_days))
@@ -5,6 +5,8 @@ from typing import List, Optional
 
 import dotenv
 from pydantic import UUID4, BaseModel
+from sqlalchemy import BigInteger, Index
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlmodel import Column, Enum, Field, Relationship, SQLModel
 
 config = dotenv.dotenv_values(".env")
@@ -96,7 +98,50 @@ class UserRequest(SQLModel, table=True):
     status: UserReqStatus = Field(
         sa_column=Column(Enum(UserReqStatus)), default=UserReqStatus.pending
     )
-    response: str = Field(nullable=True)
+    response: Optional[str] = Field(default=None, nullable=True)
     date: datetime.datetime = Field(default_factory=datetime.datetime.now)
 
     user: Users = Relationship(back_populates="requests")
+
+
+class ImportConflict(BaseModel):
+    row: int
+    username: str | None = None
+    detail: str
+
+
+class ImportReport(BaseModel):
+    created: List[str] = []
+    conflicts: List[ImportConflict] = []
+
+
+class UserRequestArchive(SQLModel, table=True):
+    __table_args__ = {"postgresql_partition_by": "RANGE (date)"}
+
+    # Partitioned tables need the partition key in the primary key.
+    id: UUID4 = Field(nullable=False, primary_key=True)
+    username: str = Field(nullable=False, index=True)
+    message: str = Field(nullable=False)
+    status: UserReqStatus = Field(
+        sa_column=Column(Enum(UserReqStatus)), default=UserReqStatus.resolved
+    )
+    response: Optional[str] = Field(default=None, nullable=True)
+    date: datetime.datetime = Field(nullable=False, primary_key=True)
+    archived_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
+
+
+class StatsCounter(SQLModel, table=True):
+    name: str = Field(nullable=False, primary_key=True)
+    key: str = Field(nullable=False, primary_key=True)
+    count: int = Field(nullable=False, default=0)
+
+
+class NewsSignature(SQLModel, table=True):
+    __table_args__ = (Index("ix_newssignature_bands", "bands", postgresql_using="gin"),)
+
+    # No foreign key: the signature is reserved before the news row exists,
+    # while the tag and summary calls run.
+    news_id: UUID4 = Field(nullable=False, primary_key=True)
+    signature: List[int] = Field(sa_column=Column(ARRAY(BigInteger), nullable=False))
+    bands: List[int] = Field(sa_column=Column(ARRAY(BigInteger), nullable=False))
+    reserved_at: datetime.datetime = Field(default_factory=datetime.datetime.now)
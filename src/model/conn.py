@@ -1,5 +1,139 @@
+import collections
+import itertools
+import logging
+import threading
+import time
+
 import sqlmodel
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
 from src.model.base_models import config
 
 engine = sqlmodel.create_engine(config["PG_CONN_STR"], echo=True)
 sqlmodel.SQLModel.metadata.create_all(engine)
+
+# How long a user who just wrote keeps reading from the primary.
+REPLICA_LAG_SECONDS = float(config.get("REPLICA_LAG_SECONDS") or 5)
+# How often replicas are health checked in the background.
+REPLICA_HEALTH_TTL_SECONDS = float(config.get("REPLICA_HEALTH_TTL_SECONDS") or 10)
+# Keeps an unreachable replica host from hanging a check or a read.
+REPLICA_CONNECT_TIMEOUT_SECONDS = int(config.get("REPLICA_CONNECT_TIMEOUT") or 2)
+
+# Comma separated list of connection strings for read-only replicas.
+replica_engines = [
+    sqlmodel.create_engine(
+        conn_str.strip(),
+        echo=True,
+        connect_args={"connect_timeout": REPLICA_CONNECT_TIMEOUT_SECONDS},
+    )
+    for conn_str in (config.get("PG_REPLICA_CONN_STRS") or "").split(",")
+    if conn_str.strip()
+]
+
+_replica_counter = itertools.count()
+_replica_health = {}
+# Ordered by deadline: every write gets the same lag and moves to the end.
+_recent_writers = collections.OrderedDict()
+_lock = threading.Lock()
+_health_checker = None
+
+
+def mark_write(username: str | None) -> None:
+    """Pin reads of ``username`` to the primary until replicas catch up."""
+    if username is None:
+        return
+    now = time.monotonic()
+    with _lock:
+        _recent_writers[username] = now + REPLICA_LAG_SECONDS
+        _recent_writers.move_to_end(username)
+        while next(iter(_recent_writers.values())) < now:
+            _recent_writers.popitem(last=False)
+
+
+def _wrote_recently(username: str | None) -> bool:
+    if username is None:
+        return False
+    with _lock:
+        deadline = _recent_writers.get(username)
+        if deadline is None:
+            return False
+        if deadline < time.monotonic():
+            del _recent_writers[username]
+            return False
+    return True
+
+
+def _ping(replica) -> bool:
+    try:
+        with replica.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception:
+        logging.warning("Replica %s is unavailable", replica.url, exc_info=True)
+        return False
+    return True
+
+
+def _check_replicas() -> None:
+    while True:
+        for replica in replica_engines:
+            _replica_health[replica] = _ping(replica)
+        time.sleep(REPLICA_HEALTH_TTL_SECONDS)
+
+
+def _ensure_health_checker() -> None:
+    # Checks run in a background thread so request handlers never wait on a
+    # replica connection; until the first check completes reads use the primary.
+    global _health_checker
+    with _lock:
+        if _health_checker is None:
+            _health_checker = threading.Thread(target=_check_replicas, daemon=True)
+            _health_checker.start()
+
+
+def _is_healthy(replica) -> bool:
+    return _replica_health.get(replica, False)
+
+
+def mark_unhealthy(replica) -> None:
+    """Stop routing reads to ``replica`` until the next health check passes."""
+    _replica_health[replica] = False
+
+
+def get_read_engine(username: str | None = None):
+    """Return an engine for read-only queries.
+
+    Falls back to the primary when no replica is configured or healthy, or
+    when ``username`` has written within ``REPLICA_LAG_SECONDS``.
+    """
+    if not replica_engines or _wrote_recently(username):
+        return engine
+
+    _ensure_health_checker()
+    for _ in range(len(replica_engines)):
+        with _lock:
+            replica = replica_engines[next(_replica_counter) % len(replica_engines)]
+        if _is_healthy(replica):
+            return replica
+
+    return engine
+
+
+def run_read(query, username: str | None = None):
+    """Run ``query(session)`` on a read engine.
+
+    If the replica fails mid-request it is marked unhealthy and the query is
+    retried on the primary.
+    """
+    read_engine = get_read_engine(username)
+    try:
+        with sqlmodel.Session(read_engine) as session:
+            return query(session)
+    except OperationalError:
+        if read_engine is engine:
+            raise
+        logging.warning("Read from replica %s failed", read_engine.url, exc_info=True)
+        mark_unhealthy(read_engine)
+
+    with sqlmodel.Session(engine) as session:
+        return query(session)
@@ -0,0 +1,153 @@
+import argparse
+import datetime
+import hashlib
+import random
+import re
+
+from sqlalchemy import func
+from sqlmodel import Session, delete, select
+
+from src.model import base_models
+from src.model.base_models import config
+from src.model.conn import engine
+
+SHINGLE_SIZE = 5
+BANDS = 16
+ROWS = 4
+NUM_PERM = BANDS * ROWS
+DUPLICATE_THRESHOLD = float(config.get("NEWS_DUPLICATE_THRESHOLD") or 0.8)
+# Reservations without news older than this were left by crashed requests.
+RESERVATION_TIMEOUT = datetime.timedelta(hours=1)
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240101)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)
+]
+
+
+def _hash(data: str) -> int:
+    return int.from_bytes(hashlib.blake2b(data.encode(), digest_size=8).digest())
+
+
+def shingles(text: str) -> set[str]:
+    words = re.findall(r"\w+", text.lower())
+    if not words:
+        return set()
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {
+        " ".join(window) for window in zip(*(words[i:] for i in range(SHINGLE_SIZE)))
+    }
+
+
+def signature(text: str) -> list[int]:
+    """MinHash signature of the word shingles of ``text``.
+
+    Empty for text without words, which cannot be compared meaningfully.
+    """
+    hashes = [_hash(shingle) for shingle in shingles(text)]
+    if not hashes:
+        return []
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def bands(sig: list[int]) -> list[int]:
+    """LSH band keys; texts sharing any key are duplicate candidates."""
+    keys = []
+    for band, start in enumerate(range(0, NUM_PERM, ROWS)):
+        rows = sig[start:][:ROWS]
+        digest = hashlib.blake2b(repr((band, rows)).encode(), digest_size=8).digest()
+        keys.append(int.from_bytes(digest, signed=True))
+    return keys
+
+
+def similarity(sig: list[int], other: list[int]) -> float:
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(a == b for a, b in zip(sig, other)) / NUM_PERM
+
+
+def find_duplicate(
+    session: Session, sig: list[int], threshold: float = DUPLICATE_THRESHOLD
+):
+    """Return the id of the most similar stored news above ``threshold``."""
+    statement = select(base_models.NewsSignature).where(
+        base_models.NewsSignature.bands.overlap(bands(sig))
+    )
+    best_id, best = None, threshold
+    for candidate in session.exec(statement).all():
+        score = similarity(sig, candidate.signature)
+        if score >= best:
+            best_id, best = candidate.news_id, score
+    return best_id
+
+
+def store(session: Session, news_id, sig: list[int]) -> None:
+    session.add(
+        base_models.NewsSignature(news_id=news_id, signature=sig, bands=bands(sig))
+    )
+
+
+def reserve(news_id, sig: list[int]):
+    """Store ``sig`` for ``news_id`` unless a near-duplicate is already stored.
+
+    Near-duplicates share at least one band key, so taking an advisory lock
+    per key makes concurrent copies check one after another. Returns the id
+    of the duplicate, or None when the signature was reserved.
+    """
+    with Session(engine) as session:
+        for key in sorted(bands(sig)):
+            session.exec(select(func.pg_advisory_xact_lock(key)))
+        duplicate_of = find_duplicate(session, sig)
+        if duplicate_of is None:
+            store(session, news_id, sig)
+        session.commit()
+    return duplicate_of
+
+
+def release(news_id) -> None:
+    """Drop the reservation of news that was not created after all."""
+    with Session(engine) as session:
+        session.exec(
+            delete(base_models.NewsSignature).where(
+                base_models.NewsSignature.news_id == news_id
+            )
+        )
+        session.commit()
+
+
+def backfill() -> int:
+    """Compute signatures for news stored before deduplication existed.
+
+    Also drops reservations that never got their news row.
+    """
+    statement = select(base_models.News).where(
+        base_models.News.id.not_in(select(base_models.NewsSignature.news_id))
+    )
+    reserved_before = datetime.datetime.now() - RESERVATION_TIMEOUT
+    stale = delete(base_models.NewsSignature).where(
+        base_models.NewsSignature.news_id.not_in(select(base_models.News.id)),
+        base_models.NewsSignature.reserved_at < reserved_before,
+    )
+    with Session(engine) as session:
+        session.exec(stale)
+        news_list = session.exec(statement).all()
+        signed = 0
+        for news in news_list:
+            sig = signature(news.text)
+            if sig:
+                store(session, news.id, sig)
+                signed += 1
+        session.commit()
+    return signed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="News near-duplicate detection")
+    parser.add_argument(
+        "--backfill", action="store_true", help="sign news without a signature"
+    )
+    args = parser.parse_args()
+
+    if args.backfill:
+        print(backfill())
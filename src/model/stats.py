@@ -0,0 +1,106 @@
+import argparse
+import collections
+
+from sqlalchemy import String, cast, func, literal, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Session, delete, select
+
+from src.model import base_models
+from src.model.conn import engine
+
+NEWS_DIMENSIONS = {
+    "news_tag": base_models.News.tag,
+    "news_category": base_models.News.category,
+    "news_day": base_models.News.date,
+}
+EVENT_DIMENSIONS = {
+    "events_location": base_models.Events.location,
+}
+
+
+def news_keys(news) -> list[tuple[str, str]]:
+    return [
+        (name, str(getattr(news, column.key)))
+        for name, column in NEWS_DIMENSIONS.items()
+        if getattr(news, column.key) is not None
+    ]
+
+
+def event_keys(event) -> list[tuple[str, str]]:
+    return [
+        (name, str(getattr(event, column.key)))
+        for name, column in EVENT_DIMENSIONS.items()
+        if getattr(event, column.key) is not None
+    ]
+
+
+def bump(session: Session, keys: list[tuple[str, str]], delta: int) -> None:
+    """Add ``delta`` to the counters in the caller's transaction."""
+    counts = collections.Counter(keys)
+    if not counts:
+        return
+
+    statement = pg_insert(base_models.StatsCounter).values(
+        [
+            {"name": name, "key": key, "count": delta * count}
+            for (name, key), count in counts.items()
+        ]
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["name", "key"],
+        set_={"count": base_models.StatsCounter.count + statement.excluded.count},
+    )
+    session.exec(statement)
+
+
+def read_stats(session: Session) -> dict[str, dict[str, int]]:
+    stats = {name: {} for name in [*NEWS_DIMENSIONS, *EVENT_DIMENSIONS]}
+    counters = session.exec(
+        select(base_models.StatsCounter).where(base_models.StatsCounter.count > 0)
+    ).all()
+    for counter in counters:
+        stats.setdefault(counter.name, {})[counter.key] = counter.count
+    return stats
+
+
+def rebuild() -> None:
+    """Recompute all counters from the news and events tables."""
+    table = base_models.StatsCounter.__tablename__
+    with Session(engine) as session:
+        # Writers wait for the rebuild, so no increment is lost or counted twice.
+        session.exec(text(f"LOCK TABLE {table} IN EXCLUSIVE MODE"))
+        session.exec(delete(base_models.StatsCounter))
+        for model, dimensions in [
+            (base_models.News, NEWS_DIMENSIONS),
+            (base_models.Events, EVENT_DIMENSIONS),
+        ]:
+            for name, column in dimensions.items():
+                totals = (
+                    select(
+                        literal(name),
+                        cast(column, String),
+                        func.count(),
+                    )
+                    .select_from(model)
+                    .where(column.is_not(None))
+                    .group_by(column)
+                )
+                session.exec(
+                    pg_insert(base_models.StatsCounter).from_select(
+                        ["name", "key", "count"], totals
+                    )
+                )
+        session.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="News and events statistics")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="recompute counters from scratch"
+    )
+    args = parser.parse_args()
+
+    if args.rebuild:
+        rebuild()
+    with Session(engine) as session:
+        print(read_stats(session))
@@ -0,0 +1,64 @@
+import asyncio
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+
+from fastapi.encoders import jsonable_encoder
+
+# Messages are dropped for subscribers that fall this far behind.
+QUEUE_SIZE = 100
+KEEP_ALIVE_SECONDS = 15
+
+# Endpoints serving event_stream; they stay open for as long as the client.
+STREAM_PATHS = {"/news/stream", "/events/stream", "/users/me/stream"}
+
+
+class Broadcaster:
+    """In-process pub/sub used to push changes to connected clients."""
+
+    def __init__(self):
+        self.channels: dict[str, set[asyncio.Queue]] = defaultdict(set)
+
+    @contextmanager
+    def subscribe(self, channels: list[str]):
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        for channel in channels:
+            self.channels[channel].add(queue)
+        try:
+            yield queue
+        finally:
+            for channel in channels:
+                self.channels[channel].discard(queue)
+                if not self.channels[channel]:
+                    del self.channels[channel]
+
+    def publish(self, channel: str, event: str, data) -> None:
+        message = {"channel": channel, "event": event, "data": jsonable_encoder(data)}
+        for queue in self.channels.get(channel, ()):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                pass
+
+
+broadcaster = Broadcaster()
+
+
+def user_channel(username: str) -> str:
+    return f"user:{username}"
+
+
+def format_sse(message: dict) -> str:
+    return f"event: {message['event']}\ndata: {json.dumps(message)}\n\n"
+
+
+async def event_stream(request, channels: list[str]):
+    """Yield Server-Sent Events for ``channels`` until the client disconnects."""
+    with broadcaster.subscribe(channels) as queue:
+        while not await request.is_disconnected():
+            try:
+                message = await asyncio.wait_for(queue.get(), KEEP_ALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield format_sse(message)
@@ -66,6 +66,81 @@ def test_delete_user_not_found():
     assert response.json() == {"detail": "User not found"}
 
 
+def test_create_user_duplicate_email():
+    user_payload = {
+        "username": "testuser_email",
+        "full_name": "Test User",
+        "email": "testuser_email@example.com",
+        "password": "secretpass",
+    }
+    response = client.post("/users/create", json=user_payload)
+    assert response.status_code == 200
+
+    user_payload["username"] = "testuser_email2"
+    response = client.post("/users/create", json=user_payload)
+    assert response.status_code == 404
+    assert response.json()["detail"] == "User already exist"
+
+    response = client.delete("/users/testuser_email")
+    assert response.status_code == 200
+    assert client.delete("/users/testuser_email2").status_code == 404
+
+
+def test_import_users():
+    from sqlmodel import Session, update
+
+    from src.model.conn import engine
+
+    admin_payload = {
+        "username": "import_admin",
+        "full_name": "Import Admin",
+        "email": "import_admin@example.com",
+        "password": "adminpass",
+    }
+    assert client.post("/users/create", json=admin_payload).status_code == 200
+    with Session(engine) as session:
+        session.exec(
+            update(base_models.Users)
+            .where(base_models.Users.username == "import_admin")
+            .values(admin=True)
+        )
+        session.commit()
+    response = client.post(
+        "/token", data={"username": "import_admin", "password": "adminpass"}
+    )
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    users_csv = (
+        "username,full_name,email,password\n"
+        "import_user1,Import User,import_user1@example.com,secretpass\n"
+        "import_user2,Import User,import_user2@example.com,secretpass\n"
+        "import_user1,Import User,import_user3@example.com,secretpass\n"
+        "darinka,Import User,import_darinka@example.com,secretpass\n"
+    )
+    files = {"file": ("users.csv", users_csv, "text/csv")}
+    assert client.post("/users/import", files=files).status_code == 401
+
+    response = client.post("/token", data={"username": "darinka2", "password": "dd"})
+    user_headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = client.post("/users/import", files=files, headers=user_headers)
+    assert response.status_code == 403
+
+    response = client.post("/users/import", files=files, headers=headers)
+    assert response.status_code == 200
+
+    report = response.json()
+    assert report["created"] == ["import_user1", "import_user2"]
+    assert [conflict["row"] for conflict in report["conflicts"]] == [3, 4]
+
+    response = client.post(
+        "/token", data={"username": "import_user2", "password": "secretpass"}
+    )
+    assert response.status_code == 200
+
+    for username in report["created"] + ["import_admin"]:
+        assert client.delete(f"/users/{username}").status_code == 200
+
+
 def test_get_all_users():
     response = client.get("/users")
     assert response.status_code == 200
@@ -133,6 +208,37 @@ def test_read_users_me():
 
 
 # ----------------USERS REQUESTS---------------------
+def test_archive_resolved_requests():
+    from src.model import archive
+
+    response = client.post("/token", data={"username": "darinka2", "password": "dd"})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    response = client.post(
+        "/user_reqs/create/",
+        json={"message": "Old request", "date": "2020-01-15T10:00:00"},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    request_id = response.json()["id"]
+
+    response = client.put(
+        f"/user_reqs/{request_id}/status/", params={"status": "Resolved"}
+    )
+    assert response.status_code == 200
+
+    assert archive.archive_resolved_requests(older_than_days=30) >= 1
+
+    ids = [r["id"] for r in client.get("/user_reqs/darinka2/items/").json()]
+    assert request_id not in ids
+
+    response = client.get("/user_reqs/darinka2/items/", params={"archived": True})
+    assert request_id in [r["id"] for r in response.json()]
+
+    response = client.get(f"/user_reqs/items/{request_id}/", params={"archived": True})
+    assert response.json()["status"] == "Resolved"
+
+
 # ----------------NEWS---------------------
 def test_get_news_by_category():
     response = client.get("/news/category/society")
@@ -251,3 +357,352 @@ def test_get_events():
 #     item = data[0]
 #     assert "item_id" in item
 #     assert "owner" in item
+
+
+# ----------------READ REPLICAS---------------------
+def test_read_engine_routing(monkeypatch):
+    from src.model import conn
+
+    replica = object()
+    monkeypatch.setattr(conn, "replica_engines", [replica])
+    monkeypatch.setattr(conn, "_ensure_health_checker", lambda: None)
+    monkeypatch.setattr(conn, "_is_healthy", lambda engine: True)
+    assert conn.get_read_engine() is replica
+
+    conn.mark_write("replica_user")
+    assert conn.get_read_engine("replica_user") is conn.engine
+    assert conn.get_read_engine("other_user") is replica
+
+    monkeypatch.setattr(conn, "_is_healthy", lambda engine: False)
+    assert conn.get_read_engine() is conn.engine
+
+
+def test_mark_write_drops_expired_writers(monkeypatch):
+    import collections
+
+    from src.model import conn
+
+    monkeypatch.setattr(conn, "_recent_writers", collections.OrderedDict())
+    monkeypatch.setattr(conn, "REPLICA_LAG_SECONDS", 0)
+    conn.mark_write("writer_1")
+    conn.mark_write("writer_2")
+
+    monkeypatch.setattr(conn, "REPLICA_LAG_SECONDS", 5)
+    conn.mark_write("writer_3")
+    assert list(conn._recent_writers) == ["writer_3"]
+
+
+def test_read_failover_to_primary(monkeypatch):
+    import sqlmodel
+    from sqlalchemy import text
+
+    from src.model import conn
+
+    replica = sqlmodel.create_engine(
+        "postgresql+psycopg2://postgres@127.0.0.1:1/postgres",
+        connect_args={"connect_timeout": 1},
+    )
+    monkeypatch.setattr(conn, "replica_engines", [replica])
+    monkeypatch.setattr(conn, "_ensure_health_checker", lambda: None)
+    monkeypatch.setitem(conn._replica_health, replica, True)
+
+    result = conn.run_read(lambda session: session.exec(text("SELECT 1")).first())
+    assert result[0] == 1
+    assert conn._replica_health[replica] is False
+    assert conn.get_read_engine() is conn.engine
+
+
+def test_read_user_request_not_found():
+    response = client.get("/user_reqs/items/7d2f0c3e-5b1a-4c9e-8f4a-2b6d1e9c0a11/")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "User request not found"}
+
+
+# ----------------STREAMING---------------------
+def test_broadcaster_publish():
+    import asyncio
+
+    from src.notify.broadcast import Broadcaster, format_sse
+
+    async def receive():
+        broadcaster = Broadcaster()
+        with broadcaster.subscribe(["news", "user:darinka"]) as queue:
+            broadcaster.publish("events", "created", {"id": 1})
+            broadcaster.publish("user:darinka", "status", {"status": "Resolved"})
+            message = queue.get_nowait()
+            assert queue.empty()
+        assert not broadcaster.channels
+        return message
+
+    message = asyncio.run(receive())
+    assert message["event"] == "status"
+    assert message["data"] == {"status": "Resolved"}
+    assert format_sse(message).startswith("event: status\ndata: ")
+
+
+def test_stream_user_from_query_token():
+    import asyncio
+
+    from fastapi import HTTPException
+
+    from src.auth import auth
+
+    response = client.post("/token", data={"username": "darinka2", "password": "dd"})
+    token = response.json()["access_token"]
+
+    user = asyncio.run(auth.get_current_stream_user(None, token))
+    assert user.username == "darinka2"
+
+    try:
+        asyncio.run(auth.get_current_stream_user(None, None))
+    except HTTPException as e:
+        assert e.status_code == 401
+    else:
+        raise AssertionError("stream without a token must be rejected")
+
+    assert client.get("/users/me/stream").status_code == 401
+
+
+# ----------------ADMISSION---------------------
+def test_admission_sheds_load():
+    import asyncio
+
+    from src.middleware.admission import AdmissionMiddleware, RouteClass
+
+    async def slow_app(scope, receive, send):
+        await asyncio.sleep(0.05)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def run():
+        route_class = RouteClass("ml", limit=1, queue=1, timeout=1)
+        middleware = AdmissionMiddleware(
+            slow_app,
+            classes={"ml": route_class, "default": route_class},
+            routes={},
+        )
+        statuses = []
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                statuses.append(message)
+
+        scope = {"type": "http", "method": "POST", "path": "/news/create"}
+        await asyncio.gather(*[middleware(scope, None, send) for _ in range(3)])
+        return route_class, statuses
+
+    route_class, statuses = asyncio.run(run())
+    assert sorted(message["status"] for message in statuses) == [200, 200, 503]
+    rejected = [message for message in statuses if message["status"] == 503][0]
+    assert (b"retry-after", b"1") in rejected["headers"]
+    assert route_class.rejected == 1
+    assert route_class.in_flight == 0
+
+
+def test_get_metrics():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'admission_rejected_total{route_class="ml"}' in response.text
+
+
+# ----------------PROFILING---------------------
+def test_sampler_collects_stacks():
+    import threading
+    import time
+
+    from src.middleware.profiling import Sampler
+
+    def busy_loop():
+        end = time.perf_counter() + 0.1
+        while time.perf_counter() < end:
+            pass
+
+    sampler = Sampler(threading.get_ident(), interval=0.001)
+    sampler.start()
+    busy_loop()
+    folded = sampler.stop()
+    assert "busy_loop" in folded
+    stack, count = folded.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+
+
+def test_sampler_follows_threadpool_calls():
+    import asyncio
+    import threading
+    import time
+
+    from src.middleware import profiling
+
+    def threadpool_busy_loop():
+        end = time.perf_counter() + 0.2
+        while time.perf_counter() < end:
+            pass
+
+    async def run():
+        sampler = profiling.Sampler(threading.get_ident(), interval=0.001)
+        token = profiling.current_sampler.set(sampler)
+        sampler.start()
+        try:
+            await profiling.run_in_threadpool(threadpool_busy_loop)
+        finally:
+            profiling.current_sampler.reset(token)
+        return sampler
+
+    sampler = asyncio.run(run())
+    folded = sampler.stop()
+    assert "threadpool_busy_loop" in folded
+    assert len(sampler.thread_ids) == 1
+
+
+def test_streams_are_not_profiled(monkeypatch):
+    import asyncio
+
+    from src.middleware import profiling
+
+    monkeypatch.setattr(profiling, "PROFILE_SAMPLE_RATE", 1)
+    assert asyncio.run(profiling._wants_profile("/events", {}))
+    for path in ["/news/stream", "/events/stream", "/users/me/stream"]:
+        headers = {b"x-profile": b"1"}
+        assert not asyncio.run(profiling._wants_profile(path, headers))
+
+
+def test_slow_query_log(monkeypatch):
+    from src.middleware import profiling
+
+    monkeypatch.setattr(profiling, "SLOW_QUERY_MS", 0)
+    profiling.slow_queries.clear()
+
+    response = client.post("/token", data={"username": "darinka2", "password": "dd"})
+    assert response.status_code == 200
+
+    query = profiling.slow_queries[-1]
+    assert query["route"] == "POST /token"
+    assert "passwords" in query["sql"]
+    assert query["parameters"] == {"username_1": "str"}
+
+
+def test_profiles_require_admin():
+    response = client.get("/admin/profiles")
+    assert response.status_code == 401
+
+    response = client.post("/token", data={"username": "darinka2", "password": "dd"})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = client.get("/admin/slow_queries", headers=headers)
+    assert response.status_code == 403
+
+
+# ----------------STATS---------------------
+def test_stats_follow_events():
+    location = "Stats Location"
+    event_data = {
+        "title": "Stats event",
+        "location": location,
+        "date": "2024-11-11",
+        "time": "18:40",
+        "contacts": "some",
+        "link": "some",
+    }
+    before = client.get("/stats").json()["events_location"].get(location, 0)
+
+    event_id = client.post("/events/create", json=event_data).json()["id"]
+    assert client.get("/stats").json()["events_location"][location] == before + 1
+
+    client.delete(f"/events/{event_id}")
+    assert client.get("/stats").json()["events_location"].get(location, 0) == before
+
+
+def test_stats_rebuild():
+    from src.model import stats
+
+    stats.rebuild()
+    events = client.get("/events").json()
+    news = client.get("/news").json()
+    after = client.get("/stats").json()
+    assert sum(after["events_location"].values()) == len(events)
+    assert sum(after["news_day"].values()) == len(news)
+
+
+# ----------------NEWS DEDUPLICATION---------------------
+NEWS_TEXT = (
+    "В городе Зарафшан открылся новый спортивный комплекс с бассейном, "
+    "футбольным полем и залом для единоборств. На церемонии открытия "
+    "выступили представители администрации и известные спортсмены. "
+    "Строительство комплекса заняло два года, его финансировали из городского "
+    "бюджета и средств местных предприятий. В комплексе будут работать секции "
+    "плавания, футбола, борьбы и бокса, а также тренажёрный зал для взрослых. "
+    "Занятия для школьников будут бесплатными, расписание опубликуют на сайте "
+    "администрации города. Первые тренировки для детей пройдут уже на следующей "
+    "неделе."
+)
+
+
+def test_minhash_similarity():
+    from src.model import dedup
+
+    edited = NEWS_TEXT.replace("следующей неделе", "этой неделе")
+    other = "Погода на выходные: ожидается дождь и сильный ветер по всей области."
+
+    signature = dedup.signature(NEWS_TEXT)
+    assert dedup.similarity(signature, dedup.signature(edited)) > 0.7
+    assert dedup.similarity(signature, dedup.signature(other)) < 0.2
+
+    assert dedup.signature("") == []
+    assert dedup.signature("!!! ??? ...") == []
+
+
+def test_reserve_near_copies_concurrently():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from src.model import dedup
+
+    copies = [NEWS_TEXT, NEWS_TEXT.replace("борьбы", "дзюдо")]
+    ids = [base_models.new_uuid() for _ in copies]
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = list(
+            pool.map(
+                lambda args: dedup.reserve(args[0], dedup.signature(args[1])),
+                zip(ids, copies),
+            )
+        )
+    try:
+        assert results.count(None) == 1
+        reserved = ids[results.index(None)]
+        assert [result for result in results if result is not None] == [reserved]
+    finally:
+        for news_id in ids:
+            dedup.release(news_id)
+
+
+def test_create_news_rejects_near_copy(monkeypatch):
+    from unittest import mock
+
+    from src import main
+
+    def fake_post(url, json):
+        response = mock.Mock()
+        response.json.return_value = {"tags": ["Спорт"], "response": "Заголовок"}
+        return response
+
+    post = mock.Mock(side_effect=fake_post)
+    monkeypatch.setattr(main.requests, "post", post)
+    monkeypatch.setenv("HOST_NEWS_TAG", "http://tags")
+    monkeypatch.setenv("HOST_SUMMARY", "http://summary")
+
+    response = client.post("/news/create", json={"text": NEWS_TEXT, "page": "p"})
+    assert response.status_code == 200
+    news_id = response.json()["id"]
+    assert post.call_count == 2
+
+    try:
+        # One changed word at the default NEWS_DUPLICATE_THRESHOLD.
+        near_copy = NEWS_TEXT.replace("бюджета", "фонда")
+        response = client.post("/news/create", json={"text": near_copy, "page": "p"})
+        assert response.status_code == 409
+        assert response.json()["detail"]["duplicate_of"] == news_id
+        assert post.call_count == 2
+    finally:
+        assert client.delete(f"/news/{news_id}").status_code == 200
+
+    response = client.post("/news/create", json={"text": NEWS_TEXT, "page": "p"})
+    assert response.status_code == 200
+    assert client.delete(f"/news/{response.json()['id']}").status_code == 200